@@ -2,14 +2,22 @@ import os
 import sys
 import sqlite3
 import json
-import subprocess
+import html
+import hashlib
+import threading
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from itertools import islice
+from itertools import islice, chain
 from youtube_comment_downloader import YoutubeCommentDownloader
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import YoutubeDLError
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn
 from rich.table import Table
 import argparse
+import atexit
 import random
 import time
 from pprint import pprint
@@ -19,102 +27,332 @@ def dier(msg):
     sys.exit(10)
 
 DB_NAME = "yt_data.db"
+CACHE_DIR = ".cache"
+PLAYLIST_CACHE_TTL = 3600  # Sekunden
+VIDEO_CHUNK_SIZE = 200
+COMMENT_CHUNK_SIZE = 500
+COMMENT_ROWS_PER_STATEMENT = 100  # 600 Parameter, bleibt unter SQLITE_MAX_VARIABLE_NUMBER (999)
+COMMENT_WORKERS = 8
+COMMENT_QUEUE_SIZE = 32  # Maximal so viele Blöcke warten auf den Schreib-Thread
+READER_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+SQL_IN_CHUNK_SIZE = 900  # Maximale Anzahl an Parametern pro IN (...)-Abfrage
+VOTE_SUFFIXES = {"K": 1_000, "M": 1_000_000, "B": 1_000_000_000}
+
+# Wiederverwendete Statements, damit der Statement-Cache von sqlite3 greift
+SQL_UPSERT_PLAYLIST = "INSERT INTO playlists (name, last_updated) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET last_updated = excluded.last_updated RETURNING id"
+SQL_UPSERT_VIDEO = "INSERT INTO videos (id, title, is_available, last_updated) VALUES (?, ?, 1, ?) ON CONFLICT(id) DO UPDATE SET last_updated = excluded.last_updated, is_available = 1"
+SQL_UPSERT_PV = "INSERT INTO playlist_videos (playlist_id, video_id, last_updated) VALUES (?, ?, ?) ON CONFLICT(playlist_id, video_id) DO UPDATE SET last_updated = excluded.last_updated"
+SQL_INSERT_COMMENT = "INSERT OR IGNORE INTO comments (id, video_id, text, author, votes, time_parsed) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_INSERT_COMMENTS_MULTI = "INSERT OR IGNORE INTO comments (id, video_id, text, author, votes, time_parsed) VALUES " + ", ".join(["(?, ?, ?, ?, ?, ?)"] * COMMENT_ROWS_PER_STATEMENT)
+SQL_INDEX_NEW_COMMENTS = "INSERT INTO fts_comments (rowid, text) SELECT pk, text FROM comments WHERE pk > ?"
+SQL_MARK_COMMENTS_DOWNLOADED = "INSERT INTO comment_downloads (video_id, last_updated) VALUES (?, ?) ON CONFLICT(video_id) DO UPDATE SET last_updated = excluded.last_updated"
+
 console = Console()
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Extrahiere YouTube-Kommentare aus einer Playlist und speichere sie in einer SQLite-Datenbank.")
     parser.add_argument("playlist_url", help="Die URL der YouTube-Playlist")
     parser.add_argument("--output_file", help="Pfad zur Outputdatei")
+    parser.add_argument("--download_comments", action="store_true", help="Kommentare aller Videos herunterladen")
+    parser.add_argument("--fast_rebuild", action="store_true", help="Datenbank im Arbeitsspeicher aufbauen und erst am Ende auf die Platte schreiben")
 
     return parser.parse_args()
 
 args = parse_args()
 
-def execute_with_retry(cur, query, params=(), delay=0.1):
-    """Führt eine SQLite-Abfrage aus und versucht es erneut, falls die Datenbank gesperrt ist."""
+def commit(conn):
+    """ Committet die Transaktion. Sperren wartet SQLite per busy_timeout selbst ab, hier wird nur protokolliert. """
+    try:
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        console.print(f"[bold red]Commit fehlgeschlagen:[/] {e}")
+        raise
+
+def _connect(readonly=False):
+    """ Öffnet eine Verbindung zur Datenbank im WAL-Modus mit angepassten PRAGMAs. """
+    if readonly:
+        conn = sqlite3.connect(f"file:{DB_NAME}?mode=ro", uri=True, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    elif args.fast_rebuild:
+        # Bestehenden Stand in den Arbeitsspeicher laden, zurückgeschrieben wird in close_db()
+        conn = sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        if os.path.exists(DB_NAME):
+            disk = sqlite3.connect(DB_NAME, timeout=30)
+            disk.backup(conn)
+            disk.close()
+    else:
+        conn = sqlite3.connect(DB_NAME, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)  # SQLite wartet selbst bis zu 30s auf Sperren
+    cur = conn.cursor()
+
+    if not readonly:
+        cur.execute("PRAGMA journal_mode=WAL")  # Idempotent, bleibt in der DB-Datei gespeichert
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")  # 64 MiB Page-Cache
+    cur.execute("PRAGMA mmap_size=268435456")  # 256 MiB Memory-Map
+    cur.execute("PRAGMA foreign_keys=ON")
+
+    cur.close()
+    return conn
+
+# Eine Schreib-Verbindung für alle Threads, dazu ein kleiner Pool von Lese-Verbindungen
+_WRITER = None
+_WRITER_LOCK = threading.Lock()
+_READERS = queue.Queue(maxsize=READER_POOL_SIZE)
+
+@contextmanager
+def _writer():
+    """ Liefert die gemeinsame Schreib-Verbindung, exklusiv für den aktuellen Thread. """
+    global _WRITER
+
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = _connect()
+        yield _WRITER
+
+@contextmanager
+def _transaction():
+    """ Führt einen Block als Schreib-Transaktion (BEGIN IMMEDIATE) aus und rollt bei Fehlern zurück. """
+    with _writer() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")  # Schreibsperre sofort holen statt mitten in der Transaktion zu scheitern
+
+        try:
+            yield cur
+            commit(conn)
+        except BaseException:
+            conn.rollback()  # Auch ein fehlgeschlagener COMMIT darf keine offene Transaktion hinterlassen
+            raise
+
+@contextmanager
+def _foreign_keys_off():
+    """ Schaltet die Fremdschlüsselprüfung der Schreib-Verbindung vorübergehend ab. Wirkt nur außerhalb einer Transaktion. """
+    with _writer() as conn:
+        conn.execute("PRAGMA foreign_keys=OFF")
+
+    try:
+        yield
+    finally:
+        with _writer() as conn:
+            conn.execute("PRAGMA foreign_keys=ON")
+
+@contextmanager
+def _reader():
+    """ Leiht eine Lese-Verbindung aus dem Pool aus und gibt sie danach zurück. """
+    if args.fast_rebuild:
+        # Die Datenbank im Arbeitsspeicher kennt nur die Schreib-Verbindung
+        with _writer() as conn:
+            yield conn
+        return
+
+    try:
+        conn = _READERS.get_nowait()
+    except queue.Empty:
+        conn = _connect(readonly=True)
+
+    try:
+        yield conn
+    finally:
+        try:
+            _READERS.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def close_db():
+    """ Schließt alle offenen Datenbankverbindungen. """
+    global _WRITER
+
     while True:
         try:
-            cur.execute(query, params)
-            return  # Erfolgreich, also raus hier
-        except sqlite3.OperationalError as e:
-            if "database is locked" in str(e).lower():
-                console.print("Waiting for DB to unlock...")
-                time.sleep(delay)  # Wartezeit zwischen Versuchen
+            _READERS.get_nowait().close()
+        except queue.Empty:
+            break
+
+    with _WRITER_LOCK:
+        if _WRITER is not None:
+            _WRITER.execute("PRAGMA optimize")  # Statistiken für den Query-Planer nach großen Ladevorgängen auffrischen
+
+            if args.fast_rebuild:
+                console.print(f"[cyan]Schreibe Datenbank nach {DB_NAME}...[/]")
+                disk = sqlite3.connect(DB_NAME, timeout=30)
+                _WRITER.backup(disk)
+                disk.close()
             else:
-                raise  # Andere Fehler direkt weiterleiten
+                _WRITER.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # WAL-Datei zwischen zwei Läufen klein halten
 
-def init_db():
-    """ Erstellt die notwendigen Tabellen, falls sie nicht existieren. """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+            _WRITER.close()
+            _WRITER = None
 
-    execute_with_retry(cur, """
-        CREATE TABLE IF NOT EXISTS playlists (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE,
-            last_updated TEXT
-        )
-    """)
-
-    execute_with_retry(cur, """
-        CREATE TABLE IF NOT EXISTS videos (
-            id TEXT PRIMARY KEY,
-            title TEXT,
-            is_available INTEGER,
-            last_updated TEXT
-        )
-    """)
-
-    execute_with_retry(cur, """
-        CREATE TABLE IF NOT EXISTS playlist_videos (
-            playlist_id INTEGER,
-            video_id TEXT,
-            last_updated TEXT,
-            FOREIGN KEY (playlist_id) REFERENCES playlists(id),
-            FOREIGN KEY (video_id) REFERENCES videos(id),
-            UNIQUE (playlist_id, video_id)
-        )
-    """)
-
-    execute_with_retry(cur, """
-        CREATE TABLE IF NOT EXISTS comments (
-            id TEXT PRIMARY KEY,
-            video_id TEXT,
-            text TEXT,
-            author TEXT,
-            votes INTEGER,
-            time_parsed INTEGER,
-            FOREIGN KEY (video_id) REFERENCES videos(id)
-        )
-    """)
-
-    execute_with_retry(cur, "CREATE VIRTUAL TABLE IF NOT EXISTS fts_comments USING fts5(id, text)")
-
-    conn.commit()
-    conn.close()
+atexit.register(close_db)  # Auch bei Abbruch oder Fehlern sauber schließen
 
-def get_playlist_videos(playlist_url):
-    """ Holt die Video-IDs und Titel einer YouTube-Playlist mit yt-dlp. """
-    command = [
-        "yt-dlp",
-        "--flat-playlist",
-        "--print", "%(id)s\t%(title)s",
-        playlist_url
-    ]
-    
-    with console.status("[bold blue]Lade Playlist-Daten...[/]", spinner="dots"):
-        result = subprocess.run(command, capture_output=True, text=True)
+def init_db():
+    """ Erstellt die notwendigen Tabellen, falls sie nicht existieren. """
+    # Ältere Versionen haben die Fremdschlüssel nicht erzwungen, verwaiste Kommentare dürfen das Umkopieren nicht verhindern
+    with _foreign_keys_off(), _transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS playlists (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE,
+                last_updated TEXT
+            )
+        """)
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS videos (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                is_available INTEGER,
+                last_updated TEXT
+            )
+        """)
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS playlist_videos (
+                playlist_id INTEGER,
+                video_id TEXT,
+                last_updated TEXT,
+                FOREIGN KEY (playlist_id) REFERENCES playlists(id),
+                FOREIGN KEY (video_id) REFERENCES videos(id),
+                UNIQUE (playlist_id, video_id)
+            )
+        """)
+
+        # pk ist ein Alias der rowid und bleibt anders als eine implizite rowid auch nach einem VACUUM stabil,
+        # fts_comments verweist darüber auf die Kommentare
+        comments_columns = """
+                pk INTEGER PRIMARY KEY,
+                id TEXT UNIQUE,
+                video_id TEXT,
+                text TEXT,
+                author TEXT,
+                votes INTEGER,
+                time_parsed INTEGER,
+                FOREIGN KEY (video_id) REFERENCES videos(id)
+        """
 
-    videos = []
-    for line in result.stdout.strip().split("\n"):
+        existing_columns = [row[1] for row in cur.execute("PRAGMA table_info(comments)")]
+        migrate_comments = bool(existing_columns) and "pk" not in existing_columns
+
+        if migrate_comments:
+            # Alte Tabelle mit TEXT-Primärschlüssel umkopieren, die bisherigen rowids werden zu pk
+            cur.execute(f"CREATE TABLE comments_new ({comments_columns})")
+            cur.execute("INSERT INTO comments_new (pk, id, video_id, text, author, votes, time_parsed) SELECT rowid, id, video_id, text, author, votes, time_parsed FROM comments")
+            cur.execute("DROP TABLE comments")
+            cur.execute("ALTER TABLE comments_new RENAME TO comments")
+
+            orphans = len(cur.execute("PRAGMA foreign_key_check(comments)").fetchall())
+            if orphans:
+                console.print(f"[yellow]{orphans} Kommentare verweisen auf Videos, die nicht in der Datenbank sind[/]")
+        else:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS comments ({comments_columns})")
+
+        # (video_id, time_parsed) deckt Abfragen nach Video ab und liefert dessen Kommentare schon chronologisch sortiert
+        cur.execute("DROP INDEX IF EXISTS idx_comments_video")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_comments_video_time ON comments(video_id, time_parsed)")
+        # Lookups nach playlist_id deckt schon der UNIQUE-Index (playlist_id, video_id) ab
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_playlist_videos_video ON playlist_videos(video_id)")
+
+        # External-Content-Tabelle: der Index verweist über comments.pk auf comments.text statt den Text zu kopieren
+        fts_sql = cur.execute("SELECT sql FROM sqlite_master WHERE name = 'fts_comments'").fetchone()
+        rebuild_fts = fts_sql is not None and (migrate_comments or "content_rowid='pk'" not in fts_sql[0])
+        if rebuild_fts:
+            cur.execute("DROP TABLE fts_comments")  # Alte Tabelle mit eigener Textkopie oder Verweis auf die implizite rowid
+
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fts_comments USING fts5(text, content='comments', content_rowid='pk', tokenize='unicode61 remove_diacritics 2')")
+
+        if rebuild_fts:
+            cur.execute("INSERT INTO fts_comments (fts_comments) VALUES ('rebuild')")
+
+        # Trigger aus älteren Versionen verweisen noch auf die implizite rowid
+        cur.execute("DROP TRIGGER IF EXISTS comments_ad")
+        cur.execute("DROP TRIGGER IF EXISTS comments_au")
+
+        cur.execute("""
+            CREATE TRIGGER comments_ad AFTER DELETE ON comments BEGIN
+                INSERT INTO fts_comments (fts_comments, rowid, text) VALUES ('delete', old.pk, old.text);
+            END
+        """)
+
+        cur.execute("""
+            CREATE TRIGGER comments_au AFTER UPDATE OF text ON comments BEGIN
+                INSERT INTO fts_comments (fts_comments, rowid, text) VALUES ('delete', old.pk, old.text);
+                INSERT INTO fts_comments (rowid, text) VALUES (new.pk, new.text);
+            END
+        """)
+
+        # fts_comments wird blockweise in derselben Transaktion wie die Kommentare befüllt, nicht mehr pro Zeile
+        cur.execute("DROP TRIGGER IF EXISTS comments_ai")
+
+        # Nur vollständig heruntergeladene Videos werden beim nächsten Lauf übersprungen, abgebrochene werden fortgesetzt
+        new_downloads_table = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'comment_downloads'").fetchone() is None
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS comment_downloads (
+                video_id TEXT PRIMARY KEY,
+                last_updated TEXT,
+                FOREIGN KEY (video_id) REFERENCES videos(id)
+            )
+        """)
+
+        if new_downloads_table:
+            # Bisher galt jedes Video mit Kommentaren als erledigt
+            cur.execute("INSERT INTO comment_downloads (video_id, last_updated) SELECT DISTINCT video_id, ? FROM comments WHERE video_id IN (SELECT id FROM videos)", (datetime.utcnow().isoformat(),))
+
+def _parse_playlist_lines(lines):
+    """ Zerlegt die Zeilen der Cache-Datei in (Video-ID, Titel)-Paare. """
+    for line in lines:
+        line = line.rstrip("\n")
         if line:
             try:
                 video_id, title = line.split("\t", 1)
-                videos.append((video_id, title))
             except ValueError:
                 console.print(f"[bold red]Fehler beim Parsen:[/]\n{line}")
+                continue
+
+            yield video_id, title
+
+def get_playlist_videos(playlist_url):
+    """ Liefert die Video-IDs und Titel einer YouTube-Playlist mit yt-dlp, sobald yt-dlp sie lädt. Die Liste wird eine Stunde lang zwischengespeichert. """
+    cache_path = os.path.join(CACHE_DIR, f"{hashlib.sha1(playlist_url.encode()).hexdigest()}.tsv")
+
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < PLAYLIST_CACHE_TTL:
+        with open(cache_path, encoding="utf-8") as f:
+            yield from _parse_playlist_lines(f)
+        return
 
-    return videos
+    ydl_opts = {
+        "extract_flat": "in_playlist",
+        "quiet": True,
+        "no_warnings": True,
+        "skip_download": True
+    }
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+
+    try:
+        with YoutubeDL(ydl_opts) as ydl, open(tmp_path, "w", encoding="utf-8") as cache:
+            # process=False liefert die Einträge als Generator, während yt-dlp noch weitere Seiten lädt
+            info = ydl.extract_info(playlist_url, download=False, process=False)
+            while info.get("_type") in ("url", "url_transparent"):
+                info = ydl.extract_info(info["url"], download=False, ie_key=info.get("ie_key"), process=False)
+
+            for entry in info.get("entries") or []:
+                video_id = entry.get("id")
+                if not video_id:
+                    continue
+
+                title = (entry.get("title") or "NA").replace("\t", " ").replace("\n", " ")  # Würde sonst die Cache-Datei zerstören
+                cache.write(f"{video_id}\t{title}\n")
+                yield video_id, title
+    except YoutubeDLError as e:  # Auch Fehler beim Nachladen weiterer Seiten im Generator
+        os.remove(tmp_path)
+        console.print(f"[bold red]Fehler beim Laden der Playlist:[/]\n{e}")
+        return
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, cache_path)  # Nur vollständige Listen cachen
 
 def show_video_table(videos):
     """ Zeigt eine formatierte Tabelle der Videos an. """
@@ -127,99 +365,196 @@ def show_video_table(videos):
 
     console.print(table)
 
+def _save_video_chunk(playlist_id, chunk):
+    """ Speichert einen Block von Videos in einer Transaktion. """
+    if not chunk:
+        return
+
+    now = datetime.utcnow().isoformat()  # Ein Zeitstempel pro Transaktion
+
+    with _transaction() as cur:
+        cur.executemany(SQL_UPSERT_VIDEO, ((video_id, title, now) for video_id, title in chunk))
+        cur.executemany(SQL_UPSERT_PV, ((playlist_id, video_id, now) for video_id, _ in chunk))
+
 def save_playlist(playlist_url, videos):
-    """ Speichert die Playlist und Videos in der Datenbank. """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+    """ Speichert die Playlist und Videos blockweise in der Datenbank, während sie noch geladen werden. """
+    now = datetime.utcnow().isoformat()
+
+    with _transaction() as cur:
+        cur.execute(SQL_UPSERT_PLAYLIST, (playlist_url, now))
+        playlist_id = cur.fetchone()[0]
 
     vids = []
+    chunk = []
 
-    execute_with_retry(cur, "INSERT OR IGNORE INTO playlists (name, last_updated) VALUES (?, ?)", 
-                (playlist_url, datetime.utcnow().isoformat()))
-    execute_with_retry(cur, "UPDATE playlists SET last_updated = ? WHERE name = ?", 
-                (datetime.utcnow().isoformat(), playlist_url))
+    with console.status("[bold blue]Lade Playlist-Daten...[/]", spinner="dots") as status:
+        for video_id, title in videos:
+            chunk.append((video_id, title))
+            vids.append([video_id, title])
 
-    execute_with_retry(cur, "SELECT id FROM playlists WHERE name = ?", (playlist_url,))
-    playlist_id = cur.fetchone()[0]
+            if len(chunk) >= VIDEO_CHUNK_SIZE:
+                _save_video_chunk(playlist_id, chunk)
+                chunk = []
+                status.update(f"[bold blue]Lade Playlist-Daten... {len(vids)} Videos gespeichert[/]")
 
-    with Progress(SpinnerColumn(), BarColumn(), TextColumn("[progress.percentage]{task.percentage:>3.0f}%"), console=console) as progress:
-        task = progress.add_task("Speichere Videos...", total=len(videos))
+        _save_video_chunk(playlist_id, chunk)
 
-        for video_id, title in videos:
-            execute_with_retry(cur, "INSERT OR IGNORE INTO videos (id, title, is_available, last_updated) VALUES (?, ?, 1, ?)",
-                        (video_id, title, datetime.utcnow().isoformat()))
-            execute_with_retry(cur, "UPDATE videos SET last_updated = ?, is_available = 1 WHERE id = ?", 
-                        (datetime.utcnow().isoformat(), video_id))
-            
-            execute_with_retry(cur, "INSERT OR IGNORE INTO playlist_videos (playlist_id, video_id, last_updated) VALUES (?, ?, ?)",
-                        (playlist_id, video_id, datetime.utcnow().isoformat()))
+    return vids
 
-            progress.update(task, advance=1)
+def get_completed_comment_downloads(video_ids):
+    """ Holt die IDs der übergebenen Videos, deren Kommentare bereits vollständig heruntergeladen wurden, blockweise statt einzeln pro Video. """
+    video_ids = list(video_ids)
+    already = set()
 
-            vids.append([video_id, title])
+    with _reader() as conn:
+        cur = conn.cursor()
 
-    conn.commit()
-    conn.close()
+        for i in range(0, len(video_ids), SQL_IN_CHUNK_SIZE):
+            chunk = video_ids[i:i + SQL_IN_CHUNK_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            already.update(row[0] for row in cur.execute(f"SELECT video_id FROM comment_downloads WHERE video_id IN ({placeholders})", chunk))
 
-    return vids
+    return already
 
-def comments_exist(video_id):
-    """ Überprüft, ob bereits Kommentare für das Video existieren. """
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def _write_comments(rows_comments, completed_video_id=None):
+    """ Schreibt Kommentare in einer Transaktion und nimmt die neuen Zeilen darin auch in den Volltextindex auf. Mit completed_video_id wird das Video als vollständig heruntergeladen markiert. """
+    n = COMMENT_ROWS_PER_STATEMENT
+    full = len(rows_comments) - len(rows_comments) % n
 
-    cur.execute("SELECT EXISTS(SELECT 1 FROM comments WHERE video_id = ? LIMIT 1)", (video_id,))
-    exists = cur.fetchone()[0]
+    with _transaction() as cur:
+        # Alles oberhalb des bisher größten pk wurde in dieser Transaktion eingefügt, per INSERT OR IGNORE übersprungene Zeilen stehen schon im Index
+        max_pk = cur.execute("SELECT COALESCE(MAX(pk), 0) FROM comments").fetchone()[0]
 
-    conn.close()
-    return bool(exists)
+        # Volle Blöcke als mehrzeilige INSERTs, der Rest Zeile für Zeile
+        cur.executemany(SQL_INSERT_COMMENTS_MULTI, (tuple(chain.from_iterable(rows_comments[i:i + n])) for i in range(0, full, n)))
+        cur.executemany(SQL_INSERT_COMMENT, rows_comments[full:])
 
-def download_comments(video_id, progress):
-    """ Lädt die Kommentare eines Videos herunter und speichert sie in der Datenbank. """
-    if comments_exist(video_id):
-        task = progress.add_task(f"Kommentare bereits runtergeladen für Video {video_id}")
-        return task
+        cur.execute(SQL_INDEX_NEW_COMMENTS, (max_pk,))
 
-    downloader = YoutubeCommentDownloader()
-    comments = downloader.get_comments_from_url(f"https://www.youtube.com/watch?v={video_id}", sort_by=0)
+        if completed_video_id is not None:
+            cur.execute(SQL_MARK_COMMENTS_DOWNLOADED, (completed_video_id, datetime.utcnow().isoformat()))
 
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    task = progress.add_task(f"Lade Kommentare für {video_id}...")
+# Ein Downloader (und damit eine requests.Session) pro Thread, damit Verbindungen wiederverwendet werden
+_THREAD_LOCAL = threading.local()
 
-    for comment in comments:
-        try:
-            votes = int(comment['votes'] or 0)
-        except:
-            votes = 0
+def _get_downloader():
+    """ Liefert den YoutubeCommentDownloader des aktuellen Threads und legt ihn bei Bedarf an. """
+    downloader = getattr(_THREAD_LOCAL, "downloader", None)
+    if downloader is None:
+        downloader = YoutubeCommentDownloader()
+        _THREAD_LOCAL.downloader = downloader
+    return downloader
+
+def _parse_kmb(s):
+    """ Wandelt abgekürzte Angaben wie '1.2K' oder '3M' in ganze Zahlen um. Unlesbare Werte ergeben 0. """
+    s = s.strip()
+    multiplier = VOTE_SUFFIXES.get(s[-1:].upper())
+
+    if multiplier:
+        s = s[:-1].replace(",", ".")  # '1,2K' mit Dezimalkomma
+    else:
+        multiplier = 1
+        s = s.replace(",", "")  # '1,234' mit Tausendertrennzeichen
+
+    try:
+        return round(float(s) * multiplier)
+    except (ValueError, OverflowError):
+        return 0
+
+def _votes(v):
+    """ Liefert die Anzahl der Likes eines Kommentars, ohne im Normalfall eine Exception auszulösen. """
+    if not v:
+        return 0
+
+    s = str(v)
+    return int(s) if s.isascii() and s.isdigit() else _parse_kmb(s)  # isdigit() allein akzeptiert auch Zeichen wie '²'
+
+def fetch_comments(video_id, batches, stop, progress):
+    """ Lädt die Kommentare eines Videos herunter und reicht sie blockweise an den Schreib-Thread weiter. Läuft in den Worker-Threads. """
+    complete = False
+
+    try:
+        time.sleep(random.uniform(0, 0.5))  # Damit nicht alle Threads gleichzeitig bei YouTube anfragen
 
-        execute_with_retry(cur, "INSERT OR IGNORE INTO comments (id, video_id, text, author, votes, time_parsed) VALUES (?, ?, ?, ?, ?, ?)",
-                    (comment['cid'], video_id, comment['text'], comment['author'], votes, comment['time_parsed']))
-        
-        execute_with_retry(cur, "INSERT OR REPLACE INTO fts_comments (id, text) VALUES (?, ?)", (comment['cid'], comment['text']))
-        progress.update(task, advance=1)
+        comments = iter(_get_downloader().get_comments_from_url(f"https://www.youtube.com/watch?v={video_id}", sort_by=0))
 
-    conn.commit()
-    conn.close()
+        task = progress.add_task(f"Lade Kommentare für {video_id}...")
 
-    return task
+        while not stop.is_set():
+            # Tupel blockweise per List Comprehension bauen, Fortschritt einmal pro Block
+            chunk = [(c['cid'], video_id, c['text'], c['author'], _votes(c['votes']), c.get('time_parsed')) for c in islice(comments, COMMENT_CHUNK_SIZE)]
+            if not chunk:
+                complete = True
+                break
+
+            batches.put((video_id, chunk, False))  # Blockiert, wenn der Schreib-Thread nicht hinterherkommt
+            progress.update(task, advance=len(chunk))
+    except Exception as e:
+        # Ein kaputtes Video soll die übrigen Downloads und die HTML-Ausgabe nicht verhindern, es wird beim nächsten Lauf erneut versucht
+        console.print(f"[red]Fehler beim Laden der Kommentare für {video_id}: {e}[/]")
+    finally:
+        batches.put((video_id, None, complete))  # Ende des Videos, nur bei Erfolg als erledigt markiert
+
+def download_all_comments(videos, already):
+    """ Lädt die Kommentare aller Videos parallel herunter. Geschrieben wird nur vom aufrufenden Thread, während die Worker weiterladen. """
+    video_ids = list(dict.fromkeys(video_id for video_id, _ in videos))  # Playlists können Videos mehrfach enthalten
+    todo = [video_id for video_id in video_ids if video_id not in already]
+
+    if len(todo) < len(video_ids):
+        console.print(f"[cyan]Kommentare bereits runtergeladen für {len(video_ids) - len(todo)} Videos[/]")
+
+    batches = queue.Queue(maxsize=COMMENT_QUEUE_SIZE)
+    stop = threading.Event()
+
+    with Progress(SpinnerColumn(), TextColumn("{task.description}"), TextColumn("{task.completed}"), console=console, refresh_per_second=4) as progress:
+        with ThreadPoolExecutor(max_workers=COMMENT_WORKERS) as executor:
+            futures = [executor.submit(fetch_comments, video_id, batches, stop, progress) for video_id in todo]
+
+            finished = 0
+
+            try:
+                while finished < len(todo):
+                    video_id, chunk, complete = batches.get()
+
+                    if chunk is not None:
+                        _write_comments(chunk)
+                    else:
+                        finished += 1
+                        if complete:
+                            _write_comments([], completed_video_id=video_id)  # Erst jetzt gilt das Video beim nächsten Lauf als erledigt
+            except BaseException:
+                stop.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+
+                # Blockierte Worker freigeben, damit sie das Stop-Signal sehen
+                while True:
+                    try:
+                        batches.get_nowait()
+                    except queue.Empty:
+                        break
+                raise
+
+            for future in futures:
+                future.result()  # Fehler aus den Worker-Threads weiterreichen
 
 def write_html_to_file(vids):
     if args.output_file:
         output_path = os.path.dirname(args.output_file)  # Verzeichnis extrahieren
 
-        inner_html = ""
+        parts = [""]
 
         for v in reversed(vids):
             video_id = v[0]
-            title = v[1]
+            title = html.escape(v[1])
+
+            parts.append(f'<a target="_blank" href="https://www.youtube.com/watch?v={video_id}"><img src="https://i.ytimg.com/vi/{video_id}/hqdefault.jpg" width="150px"><div class="caption">{title}</div></a>')
 
-            inner_html = f'{inner_html}\n<a target="_blank" href="https://www.youtube.com/watch?v={video_id}"><img src="https://i.ytimg.com/vi/{video_id}/hqdefault.jpg" width="150px"><div class="caption">{title}</div></a>'
+        inner_html = "\n".join(parts)
 
         if output_path and not os.path.exists(output_path):
             os.makedirs(output_path, exist_ok=True)  # Verzeichnis erstellen, falls nicht vorhanden
 
-        html_file = """
+        html_head = """
 <head>
 <style>#images{ text-align:center; margin:50px auto; }
 #images a{margin:0px 20px; display:inline-block; text-decoration:none; color:black; }
@@ -230,13 +565,11 @@ def write_html_to_file(vids):
 <div id="images">
             """
 
-        html_file += inner_html
-
-        html_file += """
+        html_foot = """
 </div>
 
 <center>
-<button id="random" onclick="player.loadVideoById(get_random_ytid(0))">Next random video</button><br><br>
+<button id="random" onclick="player.loadVideoById(get_random_ytid())">Next random video</button><br><br>
 <div id="player"></div>
 <center>
 
@@ -248,26 +581,29 @@ def write_html_to_file(vids):
         var anchors = document.getElementsByTagName("a");
         var youtube_ids = [];
         for(var i = 0; i < anchors.length; i++){
-                youtube_ids.push(anchors[i].href.replace("https://youtube.com/watch?v=", ""));
+                youtube_ids.push(new URL(anchors[i].href).searchParams.get("v"));
         }
 
-        function get_random_ytid (recursion) {
-                if(youtube_ids.length) {
-                        var index = Math.floor(Math.random()*youtube_ids.length);
-                        var item = youtube_ids[index];
-                        youtube_ids.splice(index, 1);
-                } else {
-                        if(recursion) {
-                                alert("Cannot get IDs");
-                        } else {
-                                for(var i = 0; i < anchors.length; i++){
-                                        youtube_ids.push(anchors[i].href.replace("https://youtube.com/watch?v=", ""));
-                                }
-                                item = get_random_ytid(1);
-                        }
+        var order = [];
+
+        function shuffle (arr) {
+                for(var i = arr.length - 1; i > 0; i--) {
+                        var j = Math.floor(Math.random()*(i + 1));
+                        var tmp = arr[i];
+                        arr[i] = arr[j];
+                        arr[j] = tmp;
                 }
-                return item;
+                return arr;
+        }
 
+        function get_random_ytid () {
+                if(!order.length) {
+                        order = shuffle(youtube_ids.slice());
+                }
+                if(!order.length) {
+                        alert("Cannot get IDs");
+                }
+                return order.pop();
         }
 
         function onPlayerReady(event) {
@@ -276,7 +612,7 @@ def write_html_to_file(vids):
 
         function onPlayerStateChange(event) {
                 if(event.data === YT.PlayerState.ENDED) {
-                        player.loadVideoById(get_random_ytid(0));
+                        player.loadVideoById(get_random_ytid());
                 }
         }
 
@@ -284,7 +620,7 @@ def write_html_to_file(vids):
                 player = new YT.Player("player", {
                         height: "390",
                         width: "640",
-                        videoId: get_random_ytid(0),
+                        videoId: get_random_ytid(),
                         playerVars: { 
                                 "autoplay": 1,
                                 "controls": 1
@@ -299,7 +635,7 @@ def write_html_to_file(vids):
         """
 
         with open(args.output_file, "w", encoding="utf-8") as f:
-            f.write(html_file)
+            f.write(html_head + inner_html + html_foot)
     else:
         console.print(f"[green]--output_file not set[/]")
 
@@ -310,13 +646,18 @@ def main():
     console.print(f"[green]✔ Datenbank initialisiert: {DB_NAME}[/]")
 
     videos = get_playlist_videos(playlist_url)
-    console.print(f"[cyan]✔ {len(videos)} Videos gefunden[/]")
-
-    show_video_table(videos)
 
     vids = save_playlist(playlist_url, videos)
+    console.print(f"[cyan]✔ {len(vids)} Videos gefunden[/]")
+
+    show_video_table(vids)
     console.print(f"[green]✔ Playlist gespeichert[/]")
 
+    if args.download_comments:
+        already = get_completed_comment_downloads(video_id for video_id, _ in vids)
+        download_all_comments(vids, already)
+        console.print(f"[green]✔ Kommentare heruntergeladen[/]")
+
     write_html_to_file(vids)
 
 if __name__ == "__main__":